@@ -1,26 +1,208 @@
+import ast
 import asyncio
+import builtins
+import json
+import logging
 import os
+import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from urllib.parse import urljoin
-from fastapi import FastAPI, HTTPException, Body
-from pydantic import BaseModel, HttpUrl, Field
+from fastapi import FastAPI, HTTPException, Body, Response, Request, Depends
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, HttpUrl, Field, TypeAdapter, ValidationError
 from typing import List
 import httpx
+import orjson
 from contextlib import asynccontextmanager
 
-from utilities import forward_response
+from utilities import forward_response, MAX_CONNECTIONS
 
-httpx_client: httpx.AsyncClient | None = None
+logger = logging.getLogger(__name__)
+
+# AI接口配置，在lifespan中根据环境变量生成一次
+_MODEL: str = ""
+_CHAT_URL: str = ""
+_HEADERS: dict[str, str] = {}
+# 预先序列化的请求体前后缀，每个请求只需序列化用户描述
+_PAYLOAD_PREFIX: bytes = b""
+_PAYLOAD_SUFFIX = b"}]}"
+
+# 匹配AI回复中可能包裹代码的markdown围栏
+_FENCE_RE = re.compile(r"^\s*```[\w-]*\s*\n|\n?\s*```\s*$")
+
+
+def _strip_fences(reply: str) -> str:
+    """去掉AI回复中的markdown代码围栏及首尾空白，使相同代码得到相同文本。"""
+    return _FENCE_RE.sub("", reply).strip()
+
+
+# AI生成代码中可以使用的名字及其允许访问的属性；这些名字只能以“名字.属性”的形式出现
+_ALLOWED_ATTRS = {
+    "httpx_client": frozenset({"get", "post", "put", "patch", "delete", "head", "options", "request"}),
+    "httpx": frozenset({"Timeout", "BasicAuth", "DigestAuth", "Headers", "Cookies", "QueryParams", "URL"}),
+    "json": frozenset({"dumps", "loads"}),
+}
+# 其他对象上允许访问的属性：响应对象的常用属性，以及dict/str/bytes/list的常用方法
+_SAFE_ATTRS = frozenset({
+    "raise_for_status", "json", "text", "content", "status_code", "headers", "cookies", "url", "encoding",
+    "reason_phrase", "is_success", "is_error",
+    "get", "items", "keys", "values", "update", "copy", "setdefault", "pop",
+    "strip", "lower", "upper", "split", "join", "replace", "startswith", "endswith", "encode", "decode",
+    "append", "extend",
+})
+_SAFE_BUILTINS = {name: getattr(builtins, name) for name in (
+    "dict", "list", "tuple", "set", "str", "int", "float", "bool", "len"
+)}
+# 不能被重新绑定的名字
+_PROTECTED_NAMES = frozenset(_ALLOWED_ATTRS) | frozenset(_SAFE_BUILTINS)
+# 循环、推导式及指数级增长的运算可能长时间占用事件循环
+_FORBIDDEN_NODES = (ast.Import, ast.ImportFrom, ast.Global, ast.Nonlocal, ast.Delete, ast.Match,
+                    ast.While, ast.For, ast.AsyncFor, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp,
+                    ast.FunctionDef, ast.ClassDef, ast.Lambda, ast.Pow, ast.LShift)
+# f-string格式说明中允许的最大宽度/精度，过大的宽度会生成超大字符串
+_MAX_FORMAT_WIDTH = 1000
+
+
+def _is_number(node: ast.expr) -> bool:
+    """判断表达式是否只由数字常量组成，如60 * 5。"""
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, (int, float))
+    if isinstance(node, ast.UnaryOp):
+        return _is_number(node.operand)
+    if isinstance(node, ast.BinOp):
+        return _is_number(node.left) and _is_number(node.right)
+    return False
+
+
+def _check_reply(tree: ast.Module):
+    """
+    检查AI生成代码的语法树，只放行形如“async def httpx_request(httpx_client): ...”且只使用白名单名字、属性和函数的代码。
+
+    不合规时抛出ValueError。
+    """
+    if (len(tree.body) != 1 or not isinstance(func := tree.body[0], ast.AsyncFunctionDef)
+            or func.name != "httpx_request" or func.decorator_list
+            or [arg.arg for arg in func.args.args] != ["httpx_client"]
+            or func.args.posonlyargs or func.args.vararg or func.args.kwonlyargs or func.args.kwarg
+            or func.args.defaults):
+        raise ValueError("reply must define only 'async def httpx_request(httpx_client)'")
+    # 合法的“名字.属性”中作为名字的节点
+    qualified = set()
+    for node in ast.walk(func):
+        if (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name)
+                and node.attr in _ALLOWED_ATTRS.get(node.value.id, ())):
+            qualified.add(node.value)
+    for node in ast.walk(func):
+        if isinstance(node, _FORBIDDEN_NODES):
+            raise ValueError(f"'{type(node).__name__}' is not allowed")
+        if isinstance(node, ast.AsyncFunctionDef) and node is not func:
+            raise ValueError("nested functions are not allowed")
+        if isinstance(node, ast.Attribute):
+            if not isinstance(node.ctx, ast.Load):
+                raise ValueError(f"assigning attribute '{node.attr}' is not allowed")
+            if node.value not in qualified and node.attr not in _SAFE_ATTRS:
+                raise ValueError(f"attribute '{node.attr}' is not allowed")
+        if isinstance(node, ast.Name):
+            if not isinstance(node.ctx, ast.Load) and node.id in _PROTECTED_NAMES:
+                raise ValueError(f"rebinding '{node.id}' is not allowed")
+            if node.id in _ALLOWED_ATTRS and node not in qualified:
+                raise ValueError(f"'{node.id}' may only be used as '{node.id}.<allowed attribute>'")
+        if isinstance(node, ast.ExceptHandler) and node.name in _PROTECTED_NAMES:
+            raise ValueError(f"rebinding '{node.name}' is not allowed")
+        # 乘法和取模只允许用于数字常量，避免'a' * 3000000000、'%3000000000s' % x之类的超大字符串
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Mult, ast.Mod)) and not _is_number(node):
+            raise ValueError(f"'{ast.unparse(node)}' is not allowed")
+        if isinstance(node, ast.AugAssign) and isinstance(node.op, (ast.Mult, ast.Mod)):
+            raise ValueError(f"'{type(node.op).__name__}' assignment is not allowed")
+        if isinstance(node, ast.FormattedValue) and node.format_spec is not None:
+            spec = ast.unparse(node.format_spec)
+            if max(map(int, re.findall(r"\d+", spec)), default=0) > _MAX_FORMAT_WIDTH:
+                raise ValueError(f"format spec '{spec}' is too wide")
+        # 属性已经过白名单检查，这里只需排除对其他表达式结果的调用
+        if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and node.func.id in _SAFE_BUILTINS
+                or isinstance(node.func, ast.Attribute)):
+            raise ValueError(f"call to '{ast.unparse(node.func)}' is not allowed")
+
+
+@lru_cache(maxsize=512)
+def _compile_reply(src: str):
+    """检查并编译AI生成的代码，相同代码只检查和编译一次。"""
+    tree = ast.parse(src, "<llm-reply>")
+    _check_reply(tree)
+    return compile(tree, "<llm-reply>", "exec")
+
+
+# AI回复缓存：(模型, 请求描述) -> (写入时间, 回复代码)，按写入时间排序，容量有限
+_REPLY_TTL = 3600.0
+_REPLY_CACHE_SIZE = 1024
+_reply_cache: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+
+
+def _cached_reply(key: tuple[str, str]) -> str | None:
+    """取未过期的缓存回复，过期的条目顺便删除。"""
+    cached = _reply_cache.get(key)
+    if cached is None:
+        return None
+    if time.monotonic() - cached[0] >= _REPLY_TTL:
+        del _reply_cache[key]
+        return None
+    return cached[1]
+
+
+def _cache_reply(key: tuple[str, str], reply: str):
+    """写入缓存，并淘汰过期条目；仍超出容量时淘汰最早写入的条目。"""
+    now = time.monotonic()
+    _reply_cache[key] = (now, reply)
+    _reply_cache.move_to_end(key)
+    while _reply_cache:
+        oldest_key, (written, _) = next(iter(_reply_cache.items()))
+        if now - written < _REPLY_TTL and len(_reply_cache) <= _REPLY_CACHE_SIZE:
+            break
+        del _reply_cache[oldest_key]
+
+
+# 正在请求AI的描述，相同描述的并发请求共享同一个AI调用任务
+_inflight: dict[tuple[str, str], asyncio.Task[str]] = {}
 
 
 @asynccontextmanager
-async def lifespan(_app: FastAPI):
-    global httpx_client
-    httpx_client = httpx.AsyncClient(timeout=httpx.Timeout(500.0, connect=10.0), verify=False)
+async def lifespan(fastapi_app: FastAPI):
+    global _MODEL, _CHAT_URL, _HEADERS, _PAYLOAD_PREFIX
+    # 每个进程共用一个连接池：AI接口和各webhook主机的连接都尽量保持复用，突发流量下避免反复TLS握手
+    fastapi_app.state.httpx = httpx.AsyncClient(
+        timeout=httpx.Timeout(500.0, connect=10.0),
+        verify=False,
+        http2=True,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=100, keepalive_expiry=60.0)
+    )
+    _MODEL = os.environ.get("MODEL", "")
+    _CHAT_URL = urljoin(os.environ.get("OPENAI_BASE_URL", "") + "/", "chat/completions")
+    _HEADERS = {
+        "Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY')}",
+        "Content-Type": "application/json"
+    }
+    static_payload = orjson.dumps({"model": _MODEL, "messages": [_SYSTEM_MSG]})
+    # 去掉末尾的"]}"，接上用户消息的开头
+    _PAYLOAD_PREFIX = static_payload[:-2] + b',{"role":"user","content":'
     yield
-    await httpx_client.aclose()
+    await fastapi_app.state.httpx.aclose()
+
+
+async def get_http(request: Request) -> httpx.AsyncClient:
+    """依赖注入：获取lifespan中创建的共享httpx客户端。"""
+    return request.app.state.httpx
 
 
-app = FastAPI(title="异步请求代理", description="将一个网络请求代理为异步请求，通过Webhook返回结果", lifespan=lifespan)
+app = FastAPI(title="异步请求代理", description="将一个网络请求代理为异步请求，通过Webhook返回结果", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
+
+# 接口的固定返回内容，预先序列化，不必每次经过jsonable_encoder和JSON编码
+_OK_BODY = b'{"code":200,"msg":"success","data":""}'
+_NO_WEBHOOKS_BODY = b'{"code":400,"msg":"no webhooks","data":""}'
 
 
 class ForwardRequest(BaseModel):
@@ -31,8 +213,8 @@ class ForwardRequest(BaseModel):
         http_desc (str): 需要转发的HTTP请求的字符串表示。这个字符串应该尽可能详细地描述请求的意图，
                          包括请求方法（GET, POST, PUT, DELETE 等）、目标URL、任何查询参数、头信息以及请求体内容。
                          例如："发送一个POST请求到'https://www.example.com'，携带JSON{'name': 'John', 'age': 30}"。
-        webhooks (List[HttpUrl]): 接收转发请求结果的Webhook URL列表。每当代理完成HTTP请求并收到响应后，
-                                  它会将响应结果发送到此列表中的每一个URL。每个URL都必须是有效的HTTP或HTTPS URL。
+        webhooks (List[str]): 接收转发请求结果的Webhook URL列表。每当代理完成HTTP请求并收到响应后，
+                              它会将响应结果发送到此列表中的每一个URL。每个URL都必须是有效的HTTP或HTTPS URL。
     """
 
     http_desc: str = Field(
@@ -42,9 +224,10 @@ class ForwardRequest(BaseModel):
         example="发送一个POST请求到'https://www.example.com'，携带JSON{'name': 'John', 'age': 30}"
     )
 
-    webhooks: List[HttpUrl] = Field(
+    webhooks: List[str] = Field(
         ...,
         min_items=0,
+        json_schema_extra={"items": {"type": "string", "format": "uri"}},
         title="Webhook URLs",
         description="接收转发请求结果的Webhook URL列表。每个URL都必须是有效的HTTP或HTTPS URL。该接口需要处理post请求，接收JSON数据，"
                     "其中包含字段response_data和response_status_code。",
@@ -52,6 +235,93 @@ class ForwardRequest(BaseModel):
     )
 
 
+# webhook URL校验器，模块加载时编译一次；先去重再校验，重复的URL只解析一次
+_WEBHOOK_URLS = TypeAdapter(List[HttpUrl])
+
+
+# 系统提示词固定不变，只在模块加载时构造一次
+_SYSTEM_MSG = {
+    "role": "system",
+    "content": "你是Python代码生成器。你会收到HTTP请求的描述，将其转化为一个叫“httpx_request”的异"
+               "步函数，该函数只接受一个参数“httpx_client”，是httpx.AsyncClient的实例，你的全部回复就是这个异步函数定义代码，"
+               "即以'async def httpx_request(httpx_client):'开头的普通文本且没有markdown代码。"
+               "代码会经过检查，不符合以下规则的代码会被拒绝："
+               f"只能调用httpx_client的{'、'.join(sorted(_ALLOWED_ATTRS['httpx_client']))}方法，"
+               f"httpx的{'、'.join(sorted(_ALLOWED_ATTRS['httpx']))}，"
+               f"json的{'、'.join(sorted(_ALLOWED_ATTRS['json']))}，"
+               f"内置函数{'、'.join(_SAFE_BUILTINS)}；其他对象上只能访问这些属性和方法：{'、'.join(sorted(_SAFE_ATTRS))}，"
+               "且不能给属性赋值；"
+               "httpx_client、httpx、json只能以“名字.属性”的形式使用，且不能对它们和上述内置函数重新赋值；"
+               "不能import，不能使用循环、推导式、嵌套函数、lambda、**和<<运算，*和%只能用于数字常量，字符串格式化请用f-string。"
+               "例如用户问题“发送一个POST请求到‘https://www.example.com’，携带JSON{\"name\":\"John\",\"age\":30}”，"
+               """那么你的全部回复是“
+               async def httpx_request(httpx_client):
+                   return await httpx_client.post('https://www.example.com', json={'name': 'John', 'age': 30})
+               ”
+               ”"""
+}
+
+
+async def _ask_llm(client: httpx.AsyncClient, http_desc: str) -> str:
+    """请求AI把HTTP请求描述转化为httpx_request函数代码。"""
+    body = _PAYLOAD_PREFIX + orjson.dumps(http_desc) + _PAYLOAD_SUFFIX
+    response = await client.post(
+        url=_CHAT_URL,
+        headers=_HEADERS,
+        content=body
+    )
+    response.raise_for_status()
+
+    try:
+        response_data = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=500, detail="Response is not valid JSON")
+
+    # Extract the relevant message content from the response
+    return _strip_fences(response_data["choices"][0]["message"]["content"])
+
+
+async def _ask_and_cache(client: httpx.AsyncClient, key: tuple[str, str], http_desc: str) -> str:
+    """请求AI并写入缓存，作为独立任务运行，不随任何一个等待它的请求被取消。"""
+    try:
+        reply = await _ask_llm(client, http_desc)
+        _cache_reply(key, reply)
+        return reply
+    finally:
+        _inflight.pop(key, None)
+
+
+async def _get_reply(client: httpx.AsyncClient, key: tuple[str, str], http_desc: str) -> str:
+    """优先从缓存取AI回复；未命中时，相同描述的并发请求共享同一个AI调用任务。"""
+    if (reply := _cached_reply(key)) is not None:
+        return reply
+    if (task := _inflight.get(key)) is None:
+        task = _inflight[key] = asyncio.create_task(_ask_and_cache(client, key, http_desc))
+        # 所有等待者都被取消时也读取异常，避免“exception was never retrieved”告警
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    # shield：某个请求被取消时不影响共享的AI调用和其他等待者
+    return await asyncio.shield(task)
+
+
+# 持有后台任务的引用，防止任务在完成前被垃圾回收
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _run_and_fanout(fn, client: httpx.AsyncClient, webhooks: List[str]):
+    """执行AI生成的请求函数，再把结果并发转发给所有webhook，同一主机的转发可复用HTTP/2连接。"""
+    try:
+        resp = await fn(client)
+    except Exception:
+        logger.exception("httpx_request执行失败")
+        return
+    # 原封不动将请求结果返给webhook
+    results = await asyncio.gather(*(forward_response(resp, webhook, client) for webhook in webhooks),
+                                   return_exceptions=True)
+    for webhook, result in zip(webhooks, results):
+        if isinstance(result, Exception):
+            logger.error("转发结果到%s失败", webhook, exc_info=result)
+
+
 @app.post("/", summary="请求代理与异步化", responses={
     200: {
         "description": "请求成功。",
@@ -60,6 +330,9 @@ class ForwardRequest(BaseModel):
                 "examples": {
                     "success": {
                         "value": {"code": 200, "msg": "success", "data": ""}
+                    },
+                    "no_webhooks": {
+                        "value": {"code": 400, "msg": "no webhooks", "data": ""}
                     }
                 }
             }
@@ -74,61 +347,44 @@ async def root(request_data: ForwardRequest = Body(
             "http://localhost:8000/receive_data"
         ]
     }
-)):
+), client: httpx.AsyncClient = Depends(get_http)):
     """
     转发HTTP请求，并异步返回结果。参数说明详见参数处具体描述。
     """
-    # ToDo把这一部分也放后台
-    payload = {
-        "model": os.environ.get("MODEL", ""),
-        "messages": [
-            {
-                "role": "system",
-                "content": "你是Python代码生成器，httpx是你主要使用的库。你会收到HTTP请求的描述，将其转化为一个叫“httpx_request”的异"
-                           "步函数，该函数只接受一个参数“httpx_client”，是httpx.AsyncClient的实例，你的全部回复就是这个异步函数定义代码，"
-                           "即以'async def httpx_request(httpx_client):'开头的普通文本且没有markdown代码。"
-                           "例如用户问题“发送一个POST请求到‘https://www.example.com’，携带JSON{\"name\":\"John\",\"age\":30}”，"
-                           """那么你的全部回复是“
-                           async def httpx_request(httpx_client):
-                               return await httpx_client.post('https://www.example.com', json={'name': 'John', 'age': 30})
-                           ”
-                           ”"""
-            },
-            {
-                "role": "user",
-                "content": request_data.http_desc
-            }
-        ]
-    }
-    response = await httpx_client.post(
-        url=urljoin(os.environ.get("OPENAI_BASE_URL") + "/", "chat/completions"),
-        headers={
-            "Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY')}",
-            "Content-Type": "application/json"
-        },
-        json=payload
-    )
-    response.raise_for_status()
+    # 去掉重复的webhook；没有webhook时结果无处可发，直接返回，不必请求AI
+    # 记录每个URL第一次出现的位置，校验出错时报告原始请求体中的下标
+    first_index: dict[str, int] = {}
+    for i, webhook in enumerate(request_data.webhooks):
+        first_index.setdefault(webhook, i)
+    positions = list(first_index.values())
+    try:
+        urls = _WEBHOOK_URLS.validate_python(list(first_index))
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", "webhooks", positions[error["loc"][0]], *error["loc"][1:])}
+             for error in e.errors()]
+        )
+    # 校验后的URL只在这里转成字符串一次，后续转发直接使用
+    webhooks: list[str] = list(dict.fromkeys(map(str, urls)))
+    if not webhooks:
+        return Response(content=_NO_WEBHOOKS_BODY, media_type="application/json")
 
+    # ToDo把这一部分也放后台
+    key = (_MODEL, request_data.http_desc.strip())
+    reply = await _get_reply(client, key, request_data.http_desc)
     try:
-        response_data = response.json()
-    except ValueError:
-        raise HTTPException(status_code=500, detail="Response is not valid JSON")
+        code = _compile_reply(reply)
+    except (SyntaxError, ValueError) as e:
+        # 不缓存不合规的回复，下次重新请求AI
+        _reply_cache.pop(key, None)
+        raise HTTPException(status_code=500, detail=f"Generated code rejected: {e}")
+    # 每个请求使用独立的命名空间，避免并发请求互相覆盖httpx_request；只暴露白名单内置函数
+    ns = {"__builtins__": _SAFE_BUILTINS, "httpx": httpx, "json": json}
+    exec(code, ns)
+    httpx_request = ns["httpx_request"]
 
-    # Extract the relevant message content from the response
-    reply = response_data["choices"][0]["message"]["content"]
-    exec(reply, globals())
-
-    # 后台任务
-    def reply_to_webhooks(task: asyncio.Task):
-        if task.exception():
-            raise task.exception()
-        # 响应结果处理
-        resp = task.result()
-        # 异步返回结果
-        for webhook in request_data.webhooks:
-            # 原封不动将请求结果返给webhook
-            asyncio.create_task(forward_response(resp, str(webhook), httpx_client))
-
-    asyncio.create_task(httpx_request(httpx_client)).add_done_callback(reply_to_webhooks)
-    return {"code": 200, "msg": "success", "data": ""}
+    # 后台任务：执行请求并异步返回结果
+    task = asyncio.create_task(_run_and_fanout(httpx_request, client, webhooks))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return Response(content=_OK_BODY, media_type="application/json")
@@ -0,0 +1,156 @@
+import ast
+import unittest
+
+from main import _check_reply
+
+
+def check(src: str):
+    _check_reply(ast.parse(src))
+
+
+class CheckReplyTest(unittest.TestCase):
+    def test_accepts_allowed_code(self):
+        for src in (
+                "async def httpx_request(httpx_client):\n"
+                "    return await httpx_client.post('https://www.example.com', json={'name': 'John', 'age': 30})",
+                "async def httpx_request(httpx_client):\n"
+                "    r = await httpx_client.get('http://x', timeout=httpx.Timeout(5.0))\n"
+                "    r.raise_for_status()\n"
+                "    return r",
+                "async def httpx_request(httpx_client):\n"
+                "    body = json.dumps({'ids': list((1, 2))})\n"
+                "    headers = dict(a='1')\n"
+                "    headers.update({'b': str(2)})\n"
+                "    return await httpx_client.post('http://x', content=body, headers=headers)",
+                "async def httpx_request(httpx_client):\n"
+                "    try:\n"
+                "        return await httpx_client.get('http://x')\n"
+                "    except Exception as e:\n"
+                "        raise e",
+                "async def httpx_request(httpx_client):\n"
+                "    n = 2 * 3\n"
+                "    n += 1\n"
+                "    return await httpx_client.get('http://x', params={'n': n})",
+                "async def httpx_request(httpx_client):\n"
+                "    r = await httpx_client.get(f'http://x/{1:>3}', timeout=60 * 5 % 7)\n"
+                "    return r.json().get('data', r.text.strip())",
+        ):
+            with self.subTest(src=src):
+                check(src)
+
+    def test_rejects_bad_signature(self):
+        for src in (
+                "import os\nasync def httpx_request(httpx_client): pass",
+                "def httpx_request(httpx_client): pass",
+                "async def other(httpx_client): pass",
+                "async def httpx_request(client): pass",
+                "async def httpx_request(httpx_client, *args): pass",
+                "async def httpx_request(httpx_client, **kwargs): pass",
+                "@decorator\nasync def httpx_request(httpx_client): pass",
+        ):
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                check(src)
+
+    def test_rejects_rebinding_protected_names(self):
+        for body in (
+                "httpx_client = httpx",
+                "dict = list",
+                "len += 1",
+                "(httpx := 1)",
+                "with httpx_client.get('http://x') as httpx_client: pass",
+                "try:\n        pass\n    except Exception as dict:\n        pass",
+        ):
+            src = f"async def httpx_request(httpx_client):\n    {body}\n    return 1"
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                check(src)
+
+    def test_rejects_unqualified_module_use(self):
+        for body in (
+                "c = httpx_client",
+                "m = httpx",
+                "return httpx.get('http://x')",
+                "return httpx.Client()",
+                "return json.load(1)",
+                "f = httpx_client.get\n    return await f('http://x')",
+        ):
+            src = f"async def httpx_request(httpx_client):\n    {body}"
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                check(src)
+
+    def test_rejects_disallowed_calls_and_attributes(self):
+        for body in (
+                "import os",
+                "return open('x')",
+                "return print('x')",
+                "return httpx_client.__class__",
+                "return '{0.__class__}'.format(httpx_client.get)",
+                "return [len][0]('x')",
+                "return open.__self__",
+                "return 'x'.ljust(10)",
+        ):
+            src = f"async def httpx_request(httpx_client):\n    {body}"
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                check(src)
+
+    def test_rejects_introspection(self):
+        for body in (
+                "c = httpx_client.get('http://x')\n"
+                "    g = c.cr_frame.f_globals\n"
+                "    c.close()\n"
+                "    return g.get('typing').sys.modules.get('os').popen('id').read()",
+                "return httpx_client.get('http://x').gi_frame",
+                "c = httpx_client.get('http://x')\n    return c.cr_frame",
+                "return c.f_globals",
+                "return c.f_builtins.get('eval')",
+        ):
+            src = f"async def httpx_request(httpx_client):\n    {body}"
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                check(src)
+
+    def test_rejects_attribute_assignment(self):
+        for body in (
+                "t = httpx.Timeout(1.0)\n"
+                "    t.f = '{0.__init__.__globals__[os].environ[OPENAI_API_KEY]}'.format\n"
+                "    return t.f(t)",
+                "r = await httpx_client.get('http://x')\n    r.encoding = 'utf-8'",
+                "r = await httpx_client.get('http://x')\n    r.text += 'x'",
+                "r = await httpx_client.get('http://x')\n    del r.text",
+        ):
+            src = f"async def httpx_request(httpx_client):\n    {body}\n    return 1"
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                check(src)
+
+    def test_rejects_memory_bombs(self):
+        for body in (
+                "x = 'a' * 3000000000",
+                "x = 3000000000 * [0]",
+                "n = 3000000000\n    x = 'a' * n",
+                "x = 'a'\n    x *= 3000000000",
+                "x = '%3000000000s' % 'a'",
+                "x = f'{1:>3000000000}'",
+                "x = bytes(3000000000)",
+        ):
+            src = f"async def httpx_request(httpx_client):\n    {body}\n    return 1"
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                check(src)
+
+    def test_rejects_loop_hogs(self):
+        for body in (
+                "while True: pass",
+                "for i in (1, 2): pass",
+                "x = [i for i in (1, 2)]",
+                "x = {i: i for i in (1, 2)}",
+                "x = (i for i in (1, 2))",
+                "x = 10 ** 10 ** 10",
+                "x = 2\n    x **= 100",
+                "x = 1 << 100000000000",
+                "def inner(): pass",
+                "f = lambda: 1",
+        ):
+            src = f"async def httpx_request(httpx_client):\n    {body}"
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                check(src)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,41 +1,49 @@
+import asyncio
 import base64
+import json
 
 import httpx
+import orjson
 
+# 共享httpx连接池的最大连接数
+MAX_CONNECTIONS = 200
+# 同时进行的webhook转发数量上限，低于MAX_CONNECTIONS，突发时为AI请求留出连接
+WEBHOOK_CONCURRENCY = 64
+_WH_SEM = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
 
-async def forward_response(r: httpx.Response, forward_url: str, client: httpx.AsyncClient | None = None):
+
+async def forward_response(r: httpx.Response, forward_url: str, client: httpx.AsyncClient):
     # 获取响应头、状态码和其他可能需要的元数据
     response_headers = r.headers
     response_status_code = r.status_code
 
-    # 根据响应的Content-Type决定如何处理内容
-    if 'application/json' in response_headers.get('Content-Type', ''):
-        # 如果是JSON数据
-        response_data = r.json()  # 获取JSON内容
-
-        post_json = {
-            'response_status_code': response_status_code,
-            'response_data': response_data
-        }
-    elif 'text' in response_headers.get('Content-Type', ''):
+    # 根据响应的Content-Type决定如何处理内容，只比较去掉参数后的MIME类型
+    content_type = response_headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+    if content_type == 'application/json':
+        # 如果是JSON数据：只校验，把原始字节原封不动拼进JSON，避免重新编码改变数据（如超大整数变成浮点数）
+        try:
+            orjson.loads(r.content)
+            body = b'{"response_status_code":%d,"response_data":%b}' % (response_status_code, r.content)
+        except orjson.JSONDecodeError:
+            # 非UTF-8编码等orjson无法直接解析的内容，交给httpx按声明的编码解析
+            body = json.dumps({
+                'response_status_code': response_status_code,
+                'response_data': r.json()
+            }).encode('utf-8')
+    elif content_type.startswith('text/'):
         # 如果是文本数据
-        post_json = {
+        body = orjson.dumps({
             'response_status_code': response_status_code,
             'response_data': r.text
-        }
+        })
     else:
-        # 其他类型的处理
-        post_json = {
-            'response_status_code': response_status_code,
-            'response_data': base64.b64encode(r.content).decode('utf-8')
-        }
+        # 其他类型的处理：base64结果只含ASCII字符，无需转义，直接拼接成JSON
+        body = b'{"response_status_code":%d,"response_data":"%b"}' % (response_status_code,
+                                                                      base64.b64encode(r.content))
 
     # 转发请求
-    new_c = None
-    client = client or (new_c := httpx.AsyncClient())
-    try:
-        forward_res = await client.post(forward_url, json=post_json)
-        # 返回转发后的响应
-        return forward_res
-    finally:
-        if new_c: await new_c.aclose()
+    async with _WH_SEM:
+        forward_res = await client.post(forward_url, content=body,
+                                        headers={"Content-Type": "application/json"})
+    # 返回转发后的响应
+    return forward_res